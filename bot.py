@@ -1,16 +1,38 @@
 import os
 import sys
+import html
 import logging
 import sqlite3
 import json
+import hmac
+import hashlib
+import queue
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from functools import wraps
+from functools import lru_cache, wraps
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request
 import telebot
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# orjson парсит апдейты Telegram в 2-5 раз быстрее stdlib json;
+# при его отсутствии тихо откатываемся на стандартный модуль
+try:
+    import orjson
+    json_loads = orjson.loads
+    json_dumps = orjson.dumps
+except ImportError:
+    json_loads = json.loads
+    json_dumps = lambda obj: json.dumps(obj).encode('utf-8')
 
 # ================ НАСТРОЙКА ЛОГИРОВАНИЯ ================
 logging.basicConfig(
@@ -49,10 +71,16 @@ if not MARZBAN_EXTERNAL_URL:
 
 # ================ CRYPTOBOT ================
 CRYPTOBOT_TOKEN = os.getenv('CRYPTOBOT_TOKEN', '')
+# Ключ подписи webhook'ов CryptoBot: sha256 от API-токена, считаем один раз
+CRYPTOBOT_WEBHOOK_KEY = hashlib.sha256(CRYPTOBOT_TOKEN.encode()).digest() if CRYPTOBOT_TOKEN else None
 
 # ================ КОНСТАНТЫ ================
 USDT_PRICE_RUB = 90
 
+# Рассылка: параллельные отправки + глобальный лимит Telegram (30 msg/s)
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '30'))
+BROADCAST_RATE = int(os.getenv('BROADCAST_RATE', '30'))
+
 TARIFFS = {
     'month': {
         'name': '1 месяц',
@@ -77,19 +105,154 @@ TARIFFS = {
     }
 }
 
+# Производные поля тарифов зависят только от констант — считаем при импорте
+for _tariff in TARIFFS.values():
+    _tariff['price_usd'] = round(_tariff['price_rub'] / USDT_PRICE_RUB, 2)
+
+# Статичная часть счёта CryptoBot по каждому тарифу тоже собирается здесь:
+# в callback'е остаётся добавить только payload с user_id
+CRYPTO_HEADERS = {'Crypto-Pay-API-Token': CRYPTOBOT_TOKEN}
+CRYPTO_INVOICE_TEMPLATES = {
+    _key: {
+        'asset': 'USDT',
+        'amount': _tariff['price_usd'],
+        'description': f'VPN {_tariff["name"]}',
+        'paid_btn_name': 'openBot',
+        'paid_btn_url': 'https://t.me/your_bot'
+    }
+    for _key, _tariff in TARIFFS.items()
+}
+
 SERVER_COUNTRY = {
     'code': 'de',
     'name': '🇩🇪 Германия (Франкфурт)',
     'flag': '🇩🇪'
 }
 
+SERVER_COUNTRY_NAME = SERVER_COUNTRY['name']
+
 VLESS_INBOUND_TAG = "VLESS TCP"  # Убедись, что совпадает с твоим inbound!
 
+# ================ СТАТИЧНЫЕ КЛАВИАТУРЫ И ТЕКСТЫ ================
+# Собираем один раз при импорте — хэндлеры не плодят одинаковые объекты
+START_MARKUP = InlineKeyboardMarkup(row_width=2)
+START_MARKUP.add(
+    InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"),
+    InlineKeyboardButton("💰 Баланс", callback_data="balance")
+)
+START_MARKUP.add(
+    InlineKeyboardButton("📱 Мои подписки", callback_data="my_subs"),
+    InlineKeyboardButton("ℹ️ Помощь", callback_data="help")
+)
+
+WELCOME_TEMPLATE = (
+    "👋 Привет, {first_name}!\n\n"
+    "🚀 **MER VPN** — быстрый и стабильный VPN\n"
+    f"🌍 **Сервер:** {SERVER_COUNTRY['name']}\n"
+    "💰 **Твой баланс:** `{balance} ₽`\n\n"
+    "👇 Выбери действие:"
+)
+
+BUY_MARKUP = InlineKeyboardMarkup()
+BUY_MARKUP.add(InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"))
+
+BUY_BACK_MARKUP = InlineKeyboardMarkup()
+BUY_BACK_MARKUP.add(InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"))
+BUY_BACK_MARKUP.add(InlineKeyboardButton("◀️ Назад", callback_data="start"))
+
+BACK_MARKUP = InlineKeyboardMarkup()
+BACK_MARKUP.add(InlineKeyboardButton("◀️ Назад", callback_data="start"))
+
+# Кнопки меню покупки: по два варианта на тариф (хватает / не хватает
+# баланса) — при клике выбираем готовую кнопку вместо сборки строк
+TARIFF_BUY_BUTTONS = {}
+for _key, _tariff in TARIFFS.items():
+    _label = f"{_tariff['name']} — {_tariff['price_rub']} ₽" + (" 🔥" if _tariff.get('popular') else "")
+    TARIFF_BUY_BUTTONS[_key] = (
+        InlineKeyboardButton(f"✅ {_label}", callback_data=f"tariff_{_key}"),
+        InlineKeyboardButton(f"⚡ {_label}", callback_data=f"tariff_{_key}"),
+    )
+
+BACK_TO_START_BUTTON = InlineKeyboardButton("◀️ Назад", callback_data="start")
+
+# Клавиатуры оплаты по тарифам: состав кнопок от пользователя не зависит,
+# поэтому собираем по одной на тариф вместо пересборки на каждый клик
+TARIFF_PAY_MARKUPS = {}
+for _key, _tariff in TARIFFS.items():
+    _markup = InlineKeyboardMarkup(row_width=1)
+    _markup.add(InlineKeyboardButton(
+        f"⭐️ Пополнить {_tariff['price_stars']} Stars",
+        callback_data=f"pay_stars_{_key}"
+    ))
+    if CRYPTOBOT_TOKEN:
+        _markup.add(InlineKeyboardButton(
+            '💲 USDT (CryptoBot)',
+            callback_data=f'pay_crypto_{_key}'
+        ))
+    _markup.add(InlineKeyboardButton("◀️ Назад", callback_data="buy"))
+    TARIFF_PAY_MARKUPS[_key] = _markup
+
+HELP_TEXT = (
+    "📚 **Доступные команды:**\n\n"
+    "/start - Главное меню\n"
+    "/balance - Проверить баланс\n"
+    "/my_subs - Мои подписки\n\n"
+    "💬 По всем вопросам: @admin"
+)
+
+HELP_CALLBACK_TEXT = (
+    "📚 **Помощь**\n\n"
+    "1. Пополни баланс или оплати тариф звёздами/USDT.\n"
+    "2. После оплаты ты получишь ссылку на подписку.\n"
+    "3. Вставь эту ссылку в приложение (v2rayNG, Streisand, Nekoray) как URL подписки.\n"
+    "4. Подключение произойдёт автоматически!\n\n"
+)
+
+# ================ HTTP-СЕССИЯ ================
+# Общая сессия с keep-alive: без неё каждый вызов Marzban/CryptoBot
+# платит за новый TCP + TLS handshake
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+))
+
 # ================ FLASK ================
 app = Flask(__name__)
 
 # ================ TELEGRAM BOT ================
 bot = telebot.TeleBot(BOT_TOKEN)
+# telebot заводит по requests.Session на каждый поток — с пулом воркеров и
+# рассылкой это десятки лишних TLS-handshake'ов. Отдаём всем общую SESSION:
+# её пул соединений с keep-alive переживает и рассылку, и обычные ответы
+telebot.apihelper._get_req_session = lambda: SESSION
+telebot.apihelper.CONNECT_TIMEOUT = 5
+telebot.apihelper.READ_TIMEOUT = 15
+
+# Кто заблокировал бота (403 из рассылки) — таким не пытаемся слать
+# уведомления, пока они снова не напишут сами
+_blocked_users = set()
+
+# ================ ФОНОВАЯ ОБРАБОТКА ================
+# Webhook отвечает Telegram 200 сразу, тяжёлая работа (хэндлеры, Marzban,
+# отправка сообщений) выполняется в фоне — иначе Telegram ретраит апдейты
+UPDATE_WORKERS = int(os.getenv('UPDATE_WORKERS', '4'))
+UPDATE_QUEUE_MAX = 10000
+_update_queue = queue.Queue(maxsize=UPDATE_QUEUE_MAX)
+
+def _update_worker():
+    while True:
+        job = _update_queue.get()
+        try:
+            job()
+        except Exception as e:
+            logger.error(f"❌ Ошибка фоновой обработки: {e}")
+        finally:
+            _update_queue.task_done()
+
+for _ in range(UPDATE_WORKERS):
+    threading.Thread(target=_update_worker, daemon=True).start()
 
 # ================ БАЗА ДАННЫХ ================
 def get_db():
@@ -97,13 +260,71 @@ def get_db():
         db_path = '/tmp/mer.db'
     else:
         db_path = 'mer.db'
-    conn = sqlite3.connect(db_path, check_same_thread=False)
+    # cached_statements: все запросы — строковые литералы, так что
+    # подготовленные statement'ы переиспользуются без повторного парсинга
+    conn = sqlite3.connect(db_path, check_same_thread=False, cached_statements=256)
     conn.row_factory = sqlite3.Row
+    # busy_timeout — на каждое соединение: при конкурентной записи
+    # SQLite сам подождёт вместо мгновенного "database is locked"
+    conn.execute('PRAGMA busy_timeout=30000')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-20000')
+    # mmap: чтения идут из отображённого файла без лишних syscall'ов
+    conn.execute('PRAGMA mmap_size=134217728')
     return conn
 
+# Пул долгоживущих соединений: connect() + разбор PRAGMA на каждый запрос
+# выбрасывал page cache SQLite. Одно выделенное соединение на запись,
+# остальные — на чтение.
+DB_POOL_SIZE = 8
+_db_pool = queue.Queue(maxsize=DB_POOL_SIZE)
+_db_write_conn = None
+_db_write_lock = threading.Lock()
+
+def _init_db_pool():
+    global _db_write_conn
+    _db_write_conn = get_db()
+    for _ in range(DB_POOL_SIZE):
+        _db_pool.put(get_db())
+
+@contextmanager
+def db():
+    """Соединение для чтения из пула."""
+    conn = _db_pool.get()
+    try:
+        yield conn
+    finally:
+        _db_pool.put(conn)
+
+@contextmanager
+def db_write():
+    """Единственное соединение для записи (рекомендация: 1 writer, N readers)."""
+    with _db_write_lock:
+        yield _db_write_conn
+
+# Версия схемы для PRAGMA user_version: тёплый рестарт пропускает миграции
+# 1 — базовая схема, 2 — epoch в expires_at + индексы,
+# 3 — индекс (status, expires_at) под агрегаты статистики,
+# 4 — индекс last_activity + ANALYZE,
+# 5 — покрывающий индекс (status, amount) вместо (status) под SUM выручки
+SCHEMA_VERSION = 5
+
 def init_db():
     conn = get_db()
     cur = conn.cursor()
+    cur.execute('PRAGMA user_version')
+    if cur.fetchone()[0] >= SCHEMA_VERSION:
+        conn.close()
+        logger.info("✅ База данных актуальна")
+        return
+    # WAL — персистентный режим журнала, достаточно включить один раз:
+    # читатели не блокируют писателя и наоборот.
+    # fetchone() обязателен: PRAGMA возвращает строку, и пока она не
+    # прочитана, statement держит курсор — executescript ниже упёрся бы
+    # в "database table is locked" на DROP INDEX
+    cur.execute('PRAGMA journal_mode=WAL')
+    cur.fetchone()
     cur.executescript('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -132,47 +353,139 @@ def init_db():
             marzban_username TEXT UNIQUE,
             subscription_url TEXT,
             country TEXT DEFAULT 'de',
-            expires_at TIMESTAMP,
+            expires_at INTEGER,
             status TEXT DEFAULT 'active',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY(user_id) REFERENCES users(user_id)
         );
+        -- Индексы под горячие предикаты: без них каждый запрос — полный скан
+        CREATE INDEX IF NOT EXISTS idx_subs_user_active
+            ON subscriptions(user_id, status, expires_at);
+        -- (status, amount) покрывает и фильтр по статусу, и SUM(amount)
+        -- в статистике — выручка считается прямо из индекса, без таблицы
+        DROP INDEX IF EXISTS idx_payments_status;
+        CREATE INDEX IF NOT EXISTS idx_payments_status_amount
+            ON payments(status, amount);
+        CREATE INDEX IF NOT EXISTS idx_subs_status_exp
+            ON subscriptions(status, expires_at);
+        CREATE INDEX IF NOT EXISTS idx_users_last_activity
+            ON users(last_activity);
+        -- Миграция старых строковых дат в Unix epoch: сравнение становится
+        -- целочисленным, без лексикографии и парсинга
+        UPDATE subscriptions
+        SET expires_at = CAST(strftime('%s', expires_at) AS INTEGER)
+        WHERE typeof(expires_at) = 'text';
+        -- ANALYZE после создания индексов, чтобы планировщик сразу их выбирал
+        ANALYZE;
     ''')
+    cur.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
     conn.commit()
     conn.close()
     logger.info("✅ База данных инициализирована")
 
 init_db()
+_init_db_pool()
+
+# Периодический PRAGMA optimize обновляет статистику планировщика
+# по мере роста таблиц (рекомендация SQLite — раз в несколько часов,
+# для нашего объёма 15 минут ничего не стоит)
+OPTIMIZE_INTERVAL = 900
+
+def _db_optimize_worker():
+    while True:
+        time.sleep(OPTIMIZE_INTERVAL)
+        try:
+            with db_write() as conn:
+                conn.execute('PRAGMA optimize')
+        except Exception as e:
+            logger.warning(f"⚠️ PRAGMA optimize: {e}")
+
+threading.Thread(target=_db_optimize_worker, daemon=True).start()
 
 # ================ MARZBAN API ================
 class MarzbanAPI:
+    # Обновляем токен заранее, чтобы параллельные запросы не упёрлись
+    # в истёкший токен одновременно
+    TOKEN_TTL = 3600
+    TOKEN_REFRESH_MARGIN = 300
+    # Файловый кэш переживает перезапуск воркера/холодный старт —
+    # без него каждый новый процесс заново ходит за токеном
+    TOKEN_CACHE_FILE = os.path.join(tempfile.gettempdir(), 'marzban_token.json')
+
     def __init__(self, base_url, username, password):
         self.base_url = base_url
         self.username = username
         self.password = password
-        self.token = None
-        self.token_expiry = None
+        # (token, deadline) одним кортежем — читатели не видят "рваное" состояние;
+        # monotonic вместо wall-clock: дешевле и не прыгает при переводе часов
+        self._token_state = None
+        self._auth_lock = threading.Lock()
+        # Статичная часть payload'а создания пользователя — собирается один раз
+        self._base_user_data = {
+            'proxies': {'vless': {}},
+            'inbounds': {'vless': [VLESS_INBOUND_TAG]},
+            'data_limit': 0,
+            'status': 'active'
+        }
 
-    def _auth(self):
-        if self.token and self.token_expiry and datetime.now() < self.token_expiry:
-            return self.token
+    def _token_valid(self):
+        state = self._token_state
+        if state and time.monotonic() < state[1] - self.TOKEN_REFRESH_MARGIN:
+            return state[0]
+        return None
+
+    def _load_token_file(self):
         try:
-            resp = requests.post(
-                f'{self.base_url}/api/admin/token',
-                data={'username': self.username, 'password': self.password},
-                timeout=10
-            )
-            if resp.status_code == 200:
-                data = resp.json()
-                self.token = data['access_token']
-                self.token_expiry = datetime.now() + timedelta(hours=1)
-                return self.token
-            else:
-                logger.error(f"Marzban auth failed: {resp.status_code} - {resp.text}")
+            with open(self.TOKEN_CACHE_FILE) as f:
+                data = json.load(f)
+            remaining = data['exp_unix'] - time.time()
+            if remaining > self.TOKEN_REFRESH_MARGIN:
+                self._token_state = (data['token'], time.monotonic() + remaining)
+                return data['token']
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    def _store_token_file(self, token):
+        tmp_path = self.TOKEN_CACHE_FILE + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'token': token, 'exp_unix': int(time.time()) + self.TOKEN_TTL}, f)
+            os.replace(tmp_path, self.TOKEN_CACHE_FILE)
+        except OSError as e:
+            logger.warning(f"⚠️ Не удалось сохранить токен Marzban в кэш: {e}")
+
+    def _auth(self):
+        token = self._token_valid()
+        if token:
+            return token
+        with self._auth_lock:
+            # Пока ждали лок, токен мог обновить другой поток
+            token = self._token_valid()
+            if token:
+                return token
+            # Может, токен уже получил соседний процесс/прошлый запуск
+            token = self._load_token_file()
+            if token:
+                return token
+            try:
+                resp = SESSION.post(
+                    f'{self.base_url}/api/admin/token',
+                    data={'username': self.username, 'password': self.password},
+                    timeout=(3.05, 10)
+                )
+                if resp.status_code == 200:
+                    data = resp.json()
+                    token = data['access_token']
+                    self._token_state = (token, time.monotonic() + self.TOKEN_TTL)
+                    self._store_token_file(token)
+                    return token
+                else:
+                    logger.error(f"Marzban auth failed: {resp.status_code} - {resp.text}")
+                    return None
+            except Exception as e:
+                logger.error(f"Marzban connection error: {e}")
                 return None
-        except Exception as e:
-            logger.error(f"Marzban connection error: {e}")
-            return None
 
     def create_user(self, user_id, days):
         token = self._auth()
@@ -181,30 +494,25 @@ class MarzbanAPI:
             return None, None
 
         headers = {'Authorization': f'Bearer {token}'}
-        expire = int((datetime.now() + timedelta(days=days)).timestamp())
-        
+        # Целые unix-секунды вместо datetime-арифметики: один вызов time()
+        # и для expire, и для имени
+        now_ts = int(time.time())
+        expire = now_ts + days * 86400
+
         # ✅ УНИКАЛЬНОЕ ИМЯ: user_{user_id}_{days}_{timestamp}
-        timestamp = int(datetime.now().timestamp())
-        username = f"user_{user_id}_{days}_{timestamp}"
+        username = f"user_{user_id}_{days}_{now_ts}"
 
-        user_data = {
-            'username': username,
-            'proxies': {'vless': {}},
-            'inbounds': {
-                'vless': [VLESS_INBOUND_TAG]
-            },
-            'expire': expire,
-            'data_limit': 0,
-            'status': 'active'
-        }
+        user_data = {**self._base_user_data, 'username': username, 'expire': expire}
 
-        logger.info(f"📤 Отправка запроса в Marzban: {json.dumps(user_data)}")
+        # json.dumps только ради лога — не платим за него на уровне INFO
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"📤 Отправка запроса в Marzban: {json.dumps(user_data)}")
         try:
-            resp = requests.post(
+            resp = SESSION.post(
                 f'{self.base_url}/api/user',
                 headers=headers,
                 json=user_data,
-                timeout=10
+                timeout=(3.05, 10)
             )
             logger.info(f"📦 Marzban create user status: {resp.status_code}")
             logger.info(f"📦 Marzban create user response: {resp.text[:500]}")
@@ -232,73 +540,143 @@ class MarzbanAPI:
 
 marzban = MarzbanAPI(MARZBAN_URL, MARZBAN_USER, MARZBAN_PASS)
 
+# Фоновое обновление токена: без него раз в час какой-то несчастливый
+# платёж ждал бы до 10 секунд, пока _auth сходит за новым токеном
+def _marzban_token_worker():
+    while True:
+        state = marzban._token_state
+        if state:
+            wait = (state[1] - MarzbanAPI.TOKEN_REFRESH_MARGIN) - time.monotonic()
+        else:
+            wait = 60
+        time.sleep(max(wait, 30))
+        if not marzban._token_valid():
+            marzban._auth()
+
+threading.Thread(target=_marzban_token_worker, daemon=True).start()
+
 # ================ ФУНКЦИИ РАБОТЫ С БАЛАНСОМ ================
+# Одна сессия кликов (buy → tariff → оплата) читает баланс несколько раз
+# в секунду — пара секунд кэша убирает повторные SELECT'ы, записи кэш сбрасывают
+READ_CACHE_TTL = 2
+READ_CACHE_MAX = 10000
+_balance_cache = {}
+_subs_cache = {}
+
+def _cache_get(cache, key):
+    entry = cache.get(key)
+    if entry and time.monotonic() < entry[0]:
+        return entry[1]
+    return None
+
+def _cache_put(cache, key, value):
+    if len(cache) >= READ_CACHE_MAX:
+        cache.clear()
+    cache[key] = (time.monotonic() + READ_CACHE_TTL, value)
+    return value
+
 def get_user_balance(user_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row['balance'] if row else 0
+    cached = _cache_get(_balance_cache, user_id)
+    if cached is not None:
+        return cached
+    with db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
+        row = cur.fetchone()
+    return _cache_put(_balance_cache, user_id, row['balance'] if row else 0)
 
 def update_user_balance(user_id, amount):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO users (user_id, balance, last_activity)
-        VALUES (?, ?, CURRENT_TIMESTAMP)
-        ON CONFLICT(user_id) DO UPDATE SET
-        balance = balance + ?,
-        last_activity = CURRENT_TIMESTAMP
-    ''', (user_id, amount, amount))
-    conn.commit()
-    conn.close()
+    _balance_cache.pop(user_id, None)
+    with db_write() as conn:
+        cur = conn.cursor()
+        # RETURNING отдаёт новый баланс тем же запросом — вызывающему
+        # не нужен повторный SELECT, чтобы показать итог пользователю
+        cur.execute('''
+            INSERT INTO users (user_id, balance, last_activity)
+            VALUES (?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT(user_id) DO UPDATE SET
+            balance = balance + ?,
+            last_activity = CURRENT_TIMESTAMP
+            RETURNING balance
+        ''', (user_id, amount, amount))
+        new_balance = cur.fetchone()['balance']
+        conn.commit()
+    return new_balance
 
 def deduct_user_balance(user_id, amount):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT balance FROM users WHERE user_id = ?', (user_id,))
-    row = cur.fetchone()
-    if not row or row['balance'] < amount:
-        conn.close()
-        return False
-    cur.execute('UPDATE users SET balance = balance - ? WHERE user_id = ?', (amount, user_id))
-    conn.commit()
-    conn.close()
-    return True
+    _balance_cache.pop(user_id, None)
+    with db_write() as conn:
+        cur = conn.cursor()
+        # Условие balance >= ? прямо в UPDATE: одно обращение вместо
+        # SELECT + UPDATE и нет гонки между проверкой и списанием
+        cur.execute('''
+            UPDATE users
+            SET balance = balance - ?, last_activity = CURRENT_TIMESTAMP
+            WHERE user_id = ? AND balance >= ?
+        ''', (amount, user_id, amount))
+        deducted = cur.rowcount == 1
+        conn.commit()
+    return deducted
 
 # ================ ФУНКЦИИ ПЛАТЕЖЕЙ ================
 def add_payment(user_id, amount, currency, payment_id, tariff, status='pending'):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO payments (user_id, amount, currency, payment_id, tariff, status)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, amount, currency, str(payment_id), tariff, status))
-    conn.commit()
-    return cur.lastrowid
+    with db_write() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            INSERT INTO payments (user_id, amount, currency, payment_id, tariff, status)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, amount, currency, str(payment_id), tariff, status))
+        conn.commit()
+        return cur.lastrowid
 
-def complete_payment(payment_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('''
-        UPDATE payments
-        SET status = 'completed', completed_at = CURRENT_TIMESTAMP
-        WHERE payment_id = ? AND status = 'pending'
-    ''', (str(payment_id),))
-    affected = cur.rowcount
-    conn.commit()
-    conn.close()
-    return affected > 0
+def apply_completed_payment(user_id, amount, currency, payment_id, tariff):
+    """Записывает завершённый платёж и зачисляет баланс одной транзакцией (один fsync).
 
-def verify_payment(payment_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT status FROM payments WHERE payment_id = ?', (str(payment_id),))
-    row = cur.fetchone()
-    conn.close()
-    if row and row['status'] == 'completed':
-        return False
+    UNIQUE по payment_id — сам по себе ключ идемпотентности: повторный
+    вебхук упирается в DO NOTHING и баланс не зачисляется второй раз.
+    """
+    global _stats_cache
+    _stats_cache = None  # выручка/платежи изменились — пусть статистика пересчитается
+    _balance_cache.pop(user_id, None)
+    with db_write() as conn:
+        with conn:
+            cur = conn.execute('''
+                INSERT INTO payments (user_id, amount, currency, payment_id, tariff, status, completed_at)
+                VALUES (?, ?, ?, ?, ?, 'completed', CURRENT_TIMESTAMP)
+                ON CONFLICT(payment_id) DO NOTHING
+            ''', (user_id, amount, currency, str(payment_id), tariff))
+            if cur.rowcount == 0:
+                return False
+            conn.execute('''
+                INSERT INTO users (user_id, balance, last_activity)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                balance = balance + excluded.balance,
+                last_activity = CURRENT_TIMESTAMP
+            ''', (user_id, amount))
+    return True
+
+def complete_payment_and_credit(payment_id, user_id, amount):
+    """Помечает pending-платёж завершённым и зачисляет баланс одной транзакцией."""
+    global _stats_cache
+    _stats_cache = None
+    _balance_cache.pop(user_id, None)
+    with db_write() as conn:
+        with conn:
+            cur = conn.execute('''
+                UPDATE payments
+                SET status = 'completed', completed_at = CURRENT_TIMESTAMP
+                WHERE payment_id = ? AND status = 'pending'
+            ''', (str(payment_id),))
+            if cur.rowcount == 0:
+                return False
+            conn.execute('''
+                INSERT INTO users (user_id, balance, last_activity)
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                balance = balance + excluded.balance,
+                last_activity = CURRENT_TIMESTAMP
+            ''', (user_id, amount))
     return True
 
 # ================ ФУНКЦИИ VPN ================
@@ -307,24 +685,26 @@ def create_vpn_subscription(user_id, days):
     if not subscription_url:
         logger.error(f"❌ Не удалось создать VPN для user {user_id}")
         return None
-    
+
+    expires_at = datetime.now() + timedelta(days=days)
+
+    _subs_cache.pop(user_id, None)
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        # INSERT OR REPLACE — если запись уже есть (но username теперь уникальный, конфликта не будет)
-        cur.execute('''
-            INSERT OR REPLACE INTO subscriptions 
-            (user_id, marzban_username, subscription_url, country, expires_at, status)
-            VALUES (?, ?, ?, ?, ?, 'active')
-        ''', (
-            user_id,
-            marzban_username,
-            subscription_url,
-            'de',
-            (datetime.now() + timedelta(days=days)).strftime('%Y-%m-%d %H:%M:%S')
-        ))
-        conn.commit()
-        conn.close()
+        with db_write() as conn:
+            cur = conn.cursor()
+            # INSERT OR REPLACE — если запись уже есть (но username теперь уникальный, конфликта не будет)
+            cur.execute('''
+                INSERT OR REPLACE INTO subscriptions
+                (user_id, marzban_username, subscription_url, country, expires_at, status)
+                VALUES (?, ?, ?, ?, ?, 'active')
+            ''', (
+                user_id,
+                marzban_username,
+                subscription_url,
+                'de',
+                int(expires_at.timestamp())
+            ))
+            conn.commit()
         logger.info(f"✅ Подписка сохранена/обновлена в БД для user {user_id}")
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения подписки в БД: {e}")
@@ -333,27 +713,123 @@ def create_vpn_subscription(user_id, days):
     return {
         'username': marzban_username,
         'subscription_url': subscription_url,
-        'expires_at': datetime.now() + timedelta(days=days),
+        'expires_at': expires_at,
         'country': SERVER_COUNTRY['name']
     }
 
+def send_subscription_message(user_id, subscription):
+    logger.info(f"📎 subscription_url = {subscription['subscription_url']}")
+    # HTML-версия (надёжнее, не ломается от спецсимволов)
+    text_html = (
+        f"✅ <b>VPN подписка активирована!</b>\n\n"
+        f"📅 Действует до: {subscription['expires_at'].strftime('%d.%m.%Y')}\n"
+        f"🌍 Страна: {subscription['country']}\n\n"
+        f"🔗 <b>Ссылка на подписку:</b>\n"
+        f"<code>{subscription['subscription_url']}</code>\n\n"
+        f"➖➖➖➖➖➖➖➖➖➖➖➖➖\n"
+        f"📱 <b>Как подключиться:</b>\n\n"
+        f"1️⃣ Скачай приложение:\n"
+        f"   • Android: <a href='https://play.google.com/store/apps/details?id=com.v2ray.ang'>v2rayNG</a>\n"
+        f"   • iOS: <a href='https://apps.apple.com/app/streisand/id6450534064'>Streisand</a>\n"
+        f"   • Windows: <a href='https://github.com/MatsuriDayo/nekoray/releases'>Nekoray</a>\n"
+        f"   • macOS: <a href='https://github.com/Cenmrev/V2RayX/releases'>V2RayX</a>\n\n"
+        f"2️⃣ В приложении выбери <b>«Добавить подписку»</b> или <b>«URL подписки»</b>\n"
+        f"3️⃣ Вставь ссылку из сообщения выше\n"
+        f"4️⃣ Нажми подключение — всё! 🔥"
+    )
+    try:
+        bot.send_message(user_id, text_html, parse_mode='HTML', disable_web_page_preview=True)
+        logger.info(f"✅ Сообщение с подпиской отправлено пользователю {user_id}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка отправки сообщения пользователю {user_id}: {e}")
+        # fallback на обычный текст без разметки
+        text_fallback = (
+            f"✅ VPN подписка активирована!\n\n"
+            f"📅 Действует до: {subscription['expires_at'].strftime('%d.%m.%Y')}\n"
+            f"🌍 Страна: {subscription['country']}\n\n"
+            f"🔗 Ссылка на подписку:\n{subscription['subscription_url']}\n\n"
+            f"Инструкция по подключению — смотрите в меню /help."
+        )
+        bot.send_message(user_id, text_fallback)
+        logger.info(f"✅ Fallback-сообщение отправлено пользователю {user_id}")
+
+# ================ ОЧЕРЕДЬ ПРОВИЖЕНИНГА ================
+# Создание VPN — три медленных шага (Marzban + БД + отправка); выносим в
+# отдельные воркеры с ретраями, чтобы не занимать обработчики апдейтов
+PROVISION_WORKERS = int(os.getenv('PROVISION_WORKERS', '4'))
+PROVISION_MAX_ATTEMPTS = 3
+_provision_queue = queue.Queue()
+
+def enqueue_vpn_provision(user_id, days, price_rub):
+    """Ставит задачу провижининга в очередь.
+
+    От двойной выдачи защищает атомарное списание (balance >= ? в UPDATE)
+    перед постановкой: повторный клик не пройдёт проверку баланса.
+    """
+    _provision_queue.put((user_id, days, price_rub, 1))
+
+def _provision_worker():
+    while True:
+        user_id, days, price_rub, attempt = _provision_queue.get()
+        try:
+            subscription = create_vpn_subscription(user_id, days)
+            if subscription:
+                send_subscription_message(user_id, subscription)
+            elif attempt < PROVISION_MAX_ATTEMPTS:
+                logger.warning(f"⚠️ Провижининг для {user_id} не удался, попытка {attempt + 1}")
+                time.sleep(2 ** attempt)
+                _provision_queue.put((user_id, days, price_rub, attempt + 1))
+            else:
+                update_user_balance(user_id, price_rub)
+                bot.send_message(user_id, "❌ Ошибка создания VPN. Деньги возвращены на баланс.")
+        except Exception as e:
+            logger.error(f"❌ Ошибка воркера провижининга: {e}")
+        finally:
+            _provision_queue.task_done()
+
+for _ in range(PROVISION_WORKERS):
+    threading.Thread(target=_provision_worker, daemon=True).start()
+
 def get_user_subscriptions(user_id):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('''
-        SELECT * FROM subscriptions
-        WHERE user_id = ? AND status = 'active' AND expires_at > datetime('now')
-        ORDER BY expires_at DESC
-    ''', (user_id,))
-    subs = cur.fetchall()
-    conn.close()
-    return subs
+    cached = _cache_get(_subs_cache, user_id)
+    if cached is not None:
+        return cached
+    with db() as conn:
+        cur = conn.cursor()
+        # Только нужные колонки: SELECT * тянул бы из страниц и длинные URL-поля
+        cur.execute('''
+            SELECT expires_at, subscription_url FROM subscriptions
+            WHERE user_id = ? AND status = 'active' AND expires_at > strftime('%s', 'now')
+            ORDER BY expires_at DESC
+        ''', (user_id,))
+        subs = cur.fetchall()
+    return _cache_put(_subs_cache, user_id, subs)
 
 # ================ УСТАНОВКА ВЕБХУКА ================
+# Боту нужны только эти типы апдейтов: остальное (edited_message,
+# channel_post, my_chat_member...) Telegram может вообще не присылать
+WEBHOOK_ALLOWED_UPDATES = ['message', 'callback_query', 'pre_checkout_query']
+
 def setup_webhook():
     try:
+        # Каждый воркер gunicorn импортирует модуль — не дёргаем remove+set,
+        # если вебхук уже настроен как надо (Telegram лимитирует эти вызовы)
+        info = bot.get_webhook_info()
+        if info.url == WEBHOOK_URL and sorted(info.allowed_updates or []) == sorted(WEBHOOK_ALLOWED_UPDATES):
+            logger.info(f"✅ Webhook уже установлен: {WEBHOOK_URL}")
+            return
         bot.remove_webhook()
-        bot.set_webhook(url=WEBHOOK_URL)
+        # Telegram лимитирует setWebhook ~1/с — при старте нескольких
+        # воркеров разом второй может словить 429, повторяем с паузой
+        for attempt in range(3):
+            try:
+                bot.set_webhook(url=WEBHOOK_URL, max_connections=100,
+                                allowed_updates=WEBHOOK_ALLOWED_UPDATES)
+                break
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code != 429 or attempt == 2:
+                    raise
+                time.sleep(2)
         logger.info(f"✅ Webhook установлен: {WEBHOOK_URL}")
     except Exception as e:
         logger.error(f"❌ Ошибка установки webhook: {e}")
@@ -377,53 +853,49 @@ def cmd_start(message):
     username = message.from_user.username
     first_name = message.from_user.first_name
     logger.info(f"🚀 /start от {user_id}")
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT OR IGNORE INTO users (user_id, username, first_name, last_activity)
-        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-    ''', (user_id, username, first_name))
-    cur.execute('UPDATE users SET last_activity = CURRENT_TIMESTAMP WHERE user_id = ?', (user_id,))
-    conn.commit()
-    conn.close()
-    balance = get_user_balance(user_id)
-    welcome_text = (
-        f"👋 Привет, {first_name or 'друг'}!\n\n"
-        f"🚀 **MER VPN** — быстрый и стабильный VPN\n"
-        f"🌍 **Сервер:** {SERVER_COUNTRY['name']}\n"
-        f"💰 **Твой баланс:** `{balance} ₽`\n\n"
-        f"👇 Выбери действие:"
-    )
-    markup = InlineKeyboardMarkup(row_width=2)
-    markup.add(
-        InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"),
-        InlineKeyboardButton("💰 Баланс", callback_data="balance")
-    )
-    markup.add(
-        InlineKeyboardButton("📱 Мои подписки", callback_data="my_subs"),
-        InlineKeyboardButton("ℹ️ Помощь", callback_data="help")
-    )
-    bot.send_message(user_id, welcome_text, parse_mode='Markdown', reply_markup=markup)
+    _blocked_users.discard(user_id)  # написал сам — значит, разблокировал
+    # Сначала дешёвое чтение: повторный /start известного пользователя со
+    # свежей активностью не должен стоить WAL-записи и fsync
+    with db() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            SELECT username, first_name,
+                   last_activity > datetime('now', '-1 hour'), balance
+            FROM users WHERE user_id = ?
+        ''', (user_id,))
+        row = cur.fetchone()
+    if row and row[0] == username and row[1] == first_name and row[2]:
+        balance = row[3]
+    else:
+        with db_write() as conn:
+            cur = conn.cursor()
+            # UPSERT вместо INSERT OR IGNORE + UPDATE: один statement, один fsync,
+            # заодно обновляем username/имя, если пользователь их сменил;
+            # RETURNING сразу отдаёт баланс — отдельный SELECT не нужен
+            cur.execute('''
+                INSERT INTO users (user_id, username, first_name, last_activity)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(user_id) DO UPDATE SET
+                username = excluded.username,
+                first_name = excluded.first_name,
+                last_activity = CURRENT_TIMESTAMP
+                RETURNING balance
+            ''', (user_id, username, first_name))
+            balance = cur.fetchone()[0]
+            conn.commit()
+    welcome_text = WELCOME_TEMPLATE.format(first_name=first_name or 'друг', balance=balance)
+    bot.send_message(user_id, welcome_text, parse_mode='Markdown', reply_markup=START_MARKUP)
 
 @bot.message_handler(commands=['help'])
 def cmd_help(message):
-    help_text = (
-        "📚 **Доступные команды:**\n\n"
-        "/start - Главное меню\n"
-        "/balance - Проверить баланс\n"
-        "/my_subs - Мои подписки\n\n"
-        "💬 По всем вопросам: @admin"
-    )
-    bot.send_message(message.chat.id, help_text, parse_mode='Markdown')
+    bot.send_message(message.chat.id, HELP_TEXT, parse_mode='Markdown')
 
 @bot.message_handler(commands=['balance'])
 def cmd_balance(message):
     user_id = message.from_user.id
     balance = get_user_balance(user_id)
     text = f"💰 **Твой баланс:** `{balance} ₽`"
-    markup = InlineKeyboardMarkup()
-    markup.add(InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"))
-    bot.send_message(user_id, text, parse_mode='Markdown', reply_markup=markup)
+    bot.send_message(user_id, text, parse_mode='Markdown', reply_markup=BUY_MARKUP)
 
 @bot.message_handler(commands=['my_subs'])
 def cmd_my_subs(message):
@@ -431,216 +903,166 @@ def cmd_my_subs(message):
     subs = get_user_subscriptions(user_id)
     if not subs:
         text = "❌ У тебя нет активных подписок"
-        markup = InlineKeyboardMarkup()
-        markup.add(InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"))
-        bot.send_message(user_id, text, reply_markup=markup)
+        bot.send_message(user_id, text, reply_markup=BUY_MARKUP)
         return
-    text = "📋 **Твои подписки:**\n\n"
-    for sub in subs:
-        text += f"🌍 {SERVER_COUNTRY['name']}\n"
-        text += f"📅 Действует до: {sub['expires_at'][:10]}\n"
-        text += f"🔗 [Ссылка на подписку]({sub['subscription_url']})\n\n"
+    # join вместо += в цикле: не переаллоцируем строку на каждую подписку
+    text = "📋 **Твои подписки:**\n\n" + ''.join(
+        f"🌍 {SERVER_COUNTRY_NAME}\n"
+        f"📅 Действует до: {datetime.fromtimestamp(sub['expires_at']):%Y-%m-%d}\n"
+        f"🔗 [Ссылка на подписку]({sub['subscription_url']})\n\n"
+        for sub in subs
+    )
     bot.send_message(user_id, text, parse_mode='Markdown', disable_web_page_preview=True)
 
-# ================ CALLBACKS ================
-@bot.callback_query_handler(func=lambda call: True)
-def callback_handler(call):
-    user_id = call.from_user.id
-    data = call.data
-    logger.info(f"🔄 Callback: {data} от {user_id}")
+# Тарифов всего три, а LabeledPrice для них неизменен — кэш насыщается
+# после первых же счетов и дальше инвойсы не аллоцируют
+@lru_cache(maxsize=16)
+def _stars_prices(tariff_key):
+    tariff = TARIFFS[tariff_key]
+    return [telebot.types.LabeledPrice(label=tariff['name'], amount=tariff['price_stars'] * 100)]
 
-    if data == "buy":
-        balance = get_user_balance(user_id)
-        text = f"📦 **Выбери тариф:**\n\n💰 Твой баланс: `{balance} ₽`\n\n"
-        markup = InlineKeyboardMarkup(row_width=1)
-        for key, tariff in TARIFFS.items():
-            popular = " 🔥" if tariff.get('popular') else ""
-            can_afford = balance >= tariff['price_rub']
-            emoji = "✅" if can_afford else "⚡"
-            markup.add(InlineKeyboardButton(
-                f"{emoji} {tariff['name']} — {tariff['price_rub']} ₽{popular}",
-                callback_data=f"tariff_{key}"
-            ))
-        markup.add(InlineKeyboardButton("◀️ Назад", callback_data="start"))
-        bot.edit_message_text(text, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
+# ================ CALLBACKS ================
+def _cb_buy(call, user_id):
+    balance = get_user_balance(user_id)
+    text = f"📦 **Выбери тариф:**\n\n💰 Твой баланс: `{balance} ₽`\n\n"
+    markup = InlineKeyboardMarkup(row_width=1)
+    for key, tariff in TARIFFS.items():
+        affordable, unaffordable = TARIFF_BUY_BUTTONS[key]
+        markup.add(affordable if balance >= tariff['price_rub'] else unaffordable)
+    markup.add(BACK_TO_START_BUTTON)
+    bot.edit_message_text(text, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
 
-    elif data.startswith("tariff_"):
-        tariff_key = data.split('_')[1]
-        tariff = TARIFFS.get(tariff_key)
-        if not tariff:
-            return
-        balance = get_user_balance(user_id)
-        if balance >= tariff['price_rub']:
-            bot.answer_callback_query(call.id, "✅ Оплачено с баланса")
-            if not deduct_user_balance(user_id, tariff['price_rub']):
-                bot.answer_callback_query(call.id, "❌ Ошибка списания", show_alert=True)
-                return
-            bot.edit_message_text(
-                "⏳ **Создаём VPN-подписку...**\nЭто займёт несколько секунд.",
-                user_id, call.message.message_id, parse_mode='Markdown'
-            )
-            subscription = create_vpn_subscription(user_id, tariff['days'])
-            if subscription:
-                logger.info(f"🚀 БЛОК ОТПРАВКИ: subscription получен, пробуем отправить...")
-                logger.info(f"📎 subscription_url = {subscription['subscription_url']}")
-                # HTML-версия (надёжнее, не ломается от спецсимволов)
-                text_html = (
-                    f"✅ <b>VPN подписка активирована!</b>\n\n"
-                    f"📅 Действует до: {subscription['expires_at'].strftime('%d.%m.%Y')}\n"
-                    f"🌍 Страна: {subscription['country']}\n\n"
-                    f"🔗 <b>Ссылка на подписку:</b>\n"
-                    f"<code>{subscription['subscription_url']}</code>\n\n"
-                    f"➖➖➖➖➖➖➖➖➖➖➖➖➖\n"
-                    f"📱 <b>Как подключиться:</b>\n\n"
-                    f"1️⃣ Скачай приложение:\n"
-                    f"   • Android: <a href='https://play.google.com/store/apps/details?id=com.v2ray.ang'>v2rayNG</a>\n"
-                    f"   • iOS: <a href='https://apps.apple.com/app/streisand/id6450534064'>Streisand</a>\n"
-                    f"   • Windows: <a href='https://github.com/MatsuriDayo/nekoray/releases'>Nekoray</a>\n"
-                    f"   • macOS: <a href='https://github.com/Cenmrev/V2RayX/releases'>V2RayX</a>\n\n"
-                    f"2️⃣ В приложении выбери <b>«Добавить подписку»</b> или <b>«URL подписки»</b>\n"
-                    f"3️⃣ Вставь ссылку из сообщения выше\n"
-                    f"4️⃣ Нажми подключение — всё! 🔥"
-                )
-                try:
-                    bot.send_message(user_id, text_html, parse_mode='HTML', disable_web_page_preview=True)
-                    logger.info(f"✅ Сообщение с подпиской отправлено пользователю {user_id}")
-                except Exception as e:
-                    logger.error(f"❌ Ошибка отправки сообщения пользователю {user_id}: {e}")
-                    # fallback на обычный текст без разметки
-                    text_fallback = (
-                        f"✅ VPN подписка активирована!\n\n"
-                        f"📅 Действует до: {subscription['expires_at'].strftime('%d.%m.%Y')}\n"
-                        f"🌍 Страна: {subscription['country']}\n\n"
-                        f"🔗 Ссылка на подписку:\n{subscription['subscription_url']}\n\n"
-                        f"Инструкция по подключению — смотрите в меню /help."
-                    )
-                    bot.send_message(user_id, text_fallback)
-                    logger.info(f"✅ Fallback-сообщение отправлено пользователю {user_id}")
-            else:
-                update_user_balance(user_id, tariff['price_rub'])
-                bot.send_message(user_id, "❌ Ошибка создания VPN. Деньги возвращены на баланс.")
+def _cb_tariff(call, user_id, tariff_key):
+    tariff = TARIFFS.get(tariff_key)
+    if not tariff:
+        return
+    balance = get_user_balance(user_id)
+    if balance >= tariff['price_rub']:
+        bot.answer_callback_query(call.id, "✅ Оплачено с баланса")
+        if not deduct_user_balance(user_id, tariff['price_rub']):
+            bot.answer_callback_query(call.id, "❌ Ошибка списания", show_alert=True)
             return
-        # Не хватает баланса
-        markup = InlineKeyboardMarkup(row_width=1)
-        markup.add(InlineKeyboardButton(
-            f"⭐️ Пополнить {tariff['price_stars']} Stars",
-            callback_data=f"pay_stars_{tariff_key}"
-        ))
-        if CRYPTOBOT_TOKEN:
-            markup.add(InlineKeyboardButton(
-                '💲 USDT (CryptoBot)',
-                callback_data=f'pay_crypto_{tariff_key}'
-            ))
-        markup.add(InlineKeyboardButton("◀️ Назад", callback_data="buy"))
         bot.edit_message_text(
-            f"📌 **Тариф:** {tariff['name']}\n"
-            f"💰 **Стоимость:** {tariff['price_rub']} ₽\n"
-            f"💳 **Твой баланс:** {balance} ₽\n"
-            f"❌ **Не хватает:** {tariff['price_rub'] - balance} ₽\n\n"
-            f"Выбери способ оплаты:",
-            user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup
+            "⏳ **Создаём VPN-подписку...**\nЭто займёт несколько секунд.",
+            user_id, call.message.message_id, parse_mode='Markdown'
         )
+        # Marzban + БД + отправка — в очереди провижининга, с ретраями
+        # и возвратом денег при неудаче
+        enqueue_vpn_provision(user_id, tariff['days'], tariff['price_rub'])
+        return
+    # Не хватает баланса
+    markup = TARIFF_PAY_MARKUPS[tariff_key]
+    bot.edit_message_text(
+        f"📌 **Тариф:** {tariff['name']}\n"
+        f"💰 **Стоимость:** {tariff['price_rub']} ₽\n"
+        f"💳 **Твой баланс:** {balance} ₽\n"
+        f"❌ **Не хватает:** {tariff['price_rub'] - balance} ₽\n\n"
+        f"Выбери способ оплаты:",
+        user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup
+    )
 
-    elif data.startswith("pay_stars_"):
-        tariff_key = data.split('_')[2]
-        tariff = TARIFFS.get(tariff_key)
-        if not tariff:
-            return
-        try:
-            stars = tariff['price_stars']
-            prices = [telebot.types.LabeledPrice(label=tariff['name'], amount=stars * 100)]
-            bot.send_invoice(
-                user_id,
-                title=f'MER VPN — {tariff["name"]}',
-                description=f'Подписка на {tariff["days"]} дней',
-                invoice_payload=f'stars_{tariff_key}_{user_id}',
-                provider_token='',
-                currency='XTR',
-                prices=prices,
-                start_parameter='create_invoice_stars'
-            )
-            bot.answer_callback_query(call.id, "✅ Счёт создан")
-        except Exception as e:
-            logger.error(f"Stars payment error: {e}")
-            bot.answer_callback_query(call.id, "❌ Ошибка создания счёта", show_alert=True)
+def _cb_pay_stars(call, user_id, tariff_key):
+    tariff = TARIFFS.get(tariff_key)
+    if not tariff:
+        return
+    try:
+        prices = _stars_prices(tariff_key)
+        bot.send_invoice(
+            user_id,
+            title=f'MER VPN — {tariff["name"]}',
+            description=f'Подписка на {tariff["days"]} дней',
+            invoice_payload=f'stars_{tariff_key}_{user_id}',
+            provider_token='',
+            currency='XTR',
+            prices=prices,
+            start_parameter='create_invoice_stars'
+        )
+        bot.answer_callback_query(call.id, "✅ Счёт создан")
+    except Exception as e:
+        logger.error(f"Stars payment error: {e}")
+        bot.answer_callback_query(call.id, "❌ Ошибка создания счёта", show_alert=True)
 
-    elif data.startswith("pay_crypto_"):
-        tariff_key = data.replace("pay_crypto_", "")
-        tariff = TARIFFS.get(tariff_key)
-        if not tariff or not CRYPTOBOT_TOKEN:
-            return
-        amount_usd = round(tariff['price_rub'] / USDT_PRICE_RUB, 2)
-        try:
-            headers = {'Crypto-Pay-API-Token': CRYPTOBOT_TOKEN}
-            payload = {
-                'asset': 'USDT',
-                'amount': amount_usd,
-                'description': f'VPN {tariff["name"]}',
-                'payload': f'crypto_{tariff_key}_{user_id}',
-                'paid_btn_name': 'openBot',
-                'paid_btn_url': 'https://t.me/your_bot'
-            }
-            resp = requests.post('https://pay.crypt.bot/api/createInvoice', headers=headers, json=payload, timeout=15)
-            if resp.status_code == 200:
-                data = resp.json()
-                if data.get('ok'):
-                    invoice = data['result']
-                    add_payment(user_id, tariff['price_rub'], 'USDT', str(invoice['invoice_id']), tariff_key, 'pending')
-                    markup = InlineKeyboardMarkup()
-                    markup.add(InlineKeyboardButton("💳 Оплатить USDT", url=invoice['pay_url']))
-                    bot.edit_message_text(
-                        f"💲 **Оплата USDT**\n\nСумма: `{amount_usd} USDT`\nТариф: {tariff['name']}\n\nНажми кнопку ниже для оплаты.",
-                        user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup
-                    )
-                    bot.answer_callback_query(call.id, "✅ Счёт создан")
-                else:
-                    bot.answer_callback_query(call.id, "❌ Ошибка создания счёта", show_alert=True)
+def _cb_pay_crypto(call, user_id, tariff_key):
+    tariff = TARIFFS.get(tariff_key)
+    if not tariff or not CRYPTOBOT_TOKEN:
+        return
+    amount_usd = tariff['price_usd']
+    try:
+        payload = {**CRYPTO_INVOICE_TEMPLATES[tariff_key], 'payload': f'crypto_{tariff_key}_{user_id}'}
+        resp = SESSION.post('https://pay.crypt.bot/api/createInvoice', headers=CRYPTO_HEADERS, json=payload, timeout=15)
+        if resp.status_code == 200:
+            data = resp.json()
+            if data.get('ok'):
+                invoice = data['result']
+                add_payment(user_id, tariff['price_rub'], 'USDT', str(invoice['invoice_id']), tariff_key, 'pending')
+                markup = InlineKeyboardMarkup()
+                markup.add(InlineKeyboardButton("💳 Оплатить USDT", url=invoice['pay_url']))
+                bot.edit_message_text(
+                    f"💲 **Оплата USDT**\n\nСумма: `{amount_usd} USDT`\nТариф: {tariff['name']}\n\nНажми кнопку ниже для оплаты.",
+                    user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup
+                )
+                bot.answer_callback_query(call.id, "✅ Счёт создан")
             else:
-                bot.answer_callback_query(call.id, "❌ Сервис временно недоступен", show_alert=True)
-        except Exception as e:
-            logger.error(f"CryptoBot error: {e}")
-            bot.answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
-
-    elif data == "balance":
-        balance = get_user_balance(user_id)
-        text = f"💰 **Твой баланс:** `{balance} ₽`"
-        markup = InlineKeyboardMarkup()
-        markup.add(InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"))
-        markup.add(InlineKeyboardButton("◀️ Назад", callback_data="start"))
-        bot.edit_message_text(text, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
-
-    elif data == "my_subs":
-        subs = get_user_subscriptions(user_id)
-        if not subs:
-            text = "❌ У тебя нет активных подписок"
-            markup = InlineKeyboardMarkup()
-            markup.add(InlineKeyboardButton("🛒 Купить подписку", callback_data="buy"))
-            markup.add(InlineKeyboardButton("◀️ Назад", callback_data="start"))
-            bot.edit_message_text(text, user_id, call.message.message_id, reply_markup=markup)
-            return
-        text = "📋 **Твои подписки:**\n\n"
-        for sub in subs:
-            text += f"🌍 {SERVER_COUNTRY['name']}\n"
-            text += f"📅 До: {sub['expires_at'][:10]}\n"
-            text += f"🔗 [Ссылка на подписку]({sub['subscription_url']})\n\n"
-        markup = InlineKeyboardMarkup()
-        markup.add(InlineKeyboardButton("◀️ Назад", callback_data="start"))
-        bot.edit_message_text(text, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup, disable_web_page_preview=True)
-
-    elif data == "help":
-        help_text = (
-            "📚 **Помощь**\n\n"
-            "1. Пополни баланс или оплати тариф звёздами/USDT.\n"
-            "2. После оплаты ты получишь ссылку на подписку.\n"
-            "3. Вставь эту ссылку в приложение (v2rayNG, Streisand, Nekoray) как URL подписки.\n"
-            "4. Подключение произойдёт автоматически!\n\n"
-        )
-        markup = InlineKeyboardMarkup()
-        markup.add(InlineKeyboardButton("◀️ Назад", callback_data="start"))
-        bot.edit_message_text(help_text, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=markup)
+                bot.answer_callback_query(call.id, "❌ Ошибка создания счёта", show_alert=True)
+        else:
+            bot.answer_callback_query(call.id, "❌ Сервис временно недоступен", show_alert=True)
+    except Exception as e:
+        logger.error(f"CryptoBot error: {e}")
+        bot.answer_callback_query(call.id, "❌ Ошибка", show_alert=True)
+
+def _cb_balance(call, user_id):
+    balance = get_user_balance(user_id)
+    text = f"💰 **Твой баланс:** `{balance} ₽`"
+    bot.edit_message_text(text, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=BUY_BACK_MARKUP)
+
+def _cb_my_subs(call, user_id):
+    subs = get_user_subscriptions(user_id)
+    if not subs:
+        text = "❌ У тебя нет активных подписок"
+        bot.edit_message_text(text, user_id, call.message.message_id, reply_markup=BUY_BACK_MARKUP)
+        return
+    text = "📋 **Твои подписки:**\n\n" + ''.join(
+        f"🌍 {SERVER_COUNTRY_NAME}\n"
+        f"📅 До: {datetime.fromtimestamp(sub['expires_at']):%Y-%m-%d}\n"
+        f"🔗 [Ссылка на подписку]({sub['subscription_url']})\n\n"
+        for sub in subs
+    )
+    bot.edit_message_text(text, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=BACK_MARKUP, disable_web_page_preview=True)
+
+def _cb_help(call, user_id):
+    bot.edit_message_text(HELP_CALLBACK_TEXT, user_id, call.message.message_id, parse_mode='Markdown', reply_markup=BACK_MARKUP)
+
+def _cb_start(call, user_id):
+    cmd_start(call.message)
 
-    elif data == "start":
-        cmd_start(call.message)
+# Диспатч вместо цепочки if/elif: точные совпадения — за один dict-lookup,
+# параметрические callback'и — по трём префиксам без split()
+_CALLBACK_EXACT = {
+    'buy': _cb_buy,
+    'balance': _cb_balance,
+    'my_subs': _cb_my_subs,
+    'help': _cb_help,
+    'start': _cb_start,
+}
+_CALLBACK_PREFIXED = (
+    ('pay_stars_', _cb_pay_stars),
+    ('pay_crypto_', _cb_pay_crypto),
+    ('tariff_', _cb_tariff),
+)
+
+@bot.callback_query_handler(func=lambda call: True)
+def callback_handler(call):
+    user_id = call.from_user.id
+    data = call.data
+    logger.info(f"🔄 Callback: {data} от {user_id}")
+    handler = _CALLBACK_EXACT.get(data)
+    if handler:
+        handler(call, user_id)
+        return
+    for prefix, handler in _CALLBACK_PREFIXED:
+        if data.startswith(prefix):
+            handler(call, user_id, data[len(prefix):])
+            return
 
 # ================ УСПЕШНАЯ ОПЛАТА STARS ================
 @bot.pre_checkout_query_handler(func=lambda query: True)
@@ -655,9 +1077,6 @@ def successful_payment_handler(message):
     logger.info(f"💰 Успешная оплата Stars от {user_id}, payload: {payload}")
     if not payload.startswith('stars_'):
         return
-    if not verify_payment(payment.telegram_payment_charge_id):
-        bot.send_message(user_id, "⚠️ Этот платёж уже был обработан.")
-        return
     parts = payload.split('_')
     if len(parts) < 3:
         return
@@ -669,8 +1088,11 @@ def successful_payment_handler(message):
     if stars_amount != tariff['price_stars']:
         logger.warning(f"⚠️ Неверная сумма звёзд: {stars_amount} вместо {tariff['price_stars']}")
     rub_amount = tariff['price_rub']
-    add_payment(user_id, rub_amount, 'XTR', payment.telegram_payment_charge_id, tariff_key, 'completed')
-    update_user_balance(user_id, rub_amount)
+    # Идемпотентность — на UNIQUE payment_id: повторная доставка апдейта
+    # упирается в DO NOTHING и не зачисляет баланс дважды
+    if not apply_completed_payment(user_id, rub_amount, 'XTR', payment.telegram_payment_charge_id, tariff_key):
+        bot.send_message(user_id, "⚠️ Этот платёж уже был обработан.")
+        return
     bot.send_message(
         user_id,
         f"✅ Баланс пополнен на {rub_amount} ₽\nТеперь ты можешь купить подписку.",
@@ -678,69 +1100,94 @@ def successful_payment_handler(message):
     )
 
 # ================ CRYPTOBOT WEBHOOK ================
+def process_crypto_invoice_paid(invoice_id, payload):
+    parts = payload.split('_')
+    if len(parts) >= 3 and parts[0] == 'crypto':
+        tariff_key = parts[1]
+        user_id = int(parts[2])
+        tariff = TARIFFS.get(tariff_key)
+        if not tariff:
+            return
+        # Условие status='pending' в UPDATE — достаточная защита от
+        # повторной обработки, предварительный SELECT не нужен
+        if complete_payment_and_credit(str(invoice_id), user_id, tariff['price_rub']):
+            bot.send_message(
+                user_id,
+                f"✅ Баланс пополнен на {tariff['price_rub']} ₽ через USDT!\nТеперь ты можешь купить подписку.",
+                parse_mode='Markdown'
+            )
+        else:
+            logger.info(f"Платёж {invoice_id} уже обработан")
+
 @app.route('/crypto_webhook', methods=['POST'])
 def crypto_webhook_handler():
     if not CRYPTOBOT_TOKEN:
         return 'CryptoBot not configured', 400
+    # Проверяем подпись до разбора JSON: спам-POST не должен трогать ни БД, ни парсер
+    body = request.get_data()
+    signature = request.headers.get('crypto-pay-api-signature', '')
+    expected = hmac.new(CRYPTOBOT_WEBHOOK_KEY, body, hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(signature, expected):
+        logger.warning("⚠️ CryptoBot webhook: неверная подпись")
+        return 'Invalid signature', 401
     try:
-        data = request.json
+        data = json_loads(body)
         logger.info(f"🔔 CryptoBot webhook: {data.get('event')}")
         if data.get('event') == 'invoice_paid':
             invoice_id = data['payload']['invoice_id']
             payload = data['payload'].get('payload', '')
-            if not verify_payment(str(invoice_id)):
-                logger.info(f"Платёж {invoice_id} уже обработан")
-                return 'OK', 200
-            if complete_payment(str(invoice_id)):
-                parts = payload.split('_')
-                if len(parts) >= 3 and parts[0] == 'crypto':
-                    tariff_key = parts[1]
-                    user_id = int(parts[2])
-                    tariff = TARIFFS.get(tariff_key)
-                    if tariff:
-                        update_user_balance(user_id, tariff['price_rub'])
-                        bot.send_message(
-                            user_id,
-                            f"✅ Баланс пополнен на {tariff['price_rub']} ₽ через USDT!\nТеперь ты можешь купить подписку.",
-                            parse_mode='Markdown'
-                        )
+            # Ответ CryptoBot сразу, обновление БД и отправка — в фоне
+            _update_queue.put(lambda: process_crypto_invoice_paid(invoice_id, payload))
         return 'OK', 200
     except Exception as e:
         logger.error(f"CryptoBot webhook error: {e}")
         return 'Error', 500
 
 # ================ АДМИН-КОМАНДЫ ================
+# Агрегаты статистики меняются медленно — держим результат 30 секунд,
+# чтобы частые /admin_stats не гоняли COUNT/SUM по всем таблицам
+STATS_CACHE_TTL = 30
+_stats_cache = None
+
+def _fetch_stats():
+    global _stats_cache
+    cached = _stats_cache
+    if cached and time.monotonic() < cached[0]:
+        return cached[1]
+    with db() as conn:
+        cur = conn.cursor()
+        # Один SELECT со скалярными подзапросами вместо шести round-trip'ов
+        cur.execute('''
+            SELECT
+                (SELECT COUNT(*) FROM users),
+                (SELECT COUNT(*) FROM users WHERE last_activity > datetime('now', '-7 days')),
+                (SELECT COUNT(*) FROM payments WHERE status = 'completed'),
+                (SELECT COALESCE(SUM(amount), 0) FROM payments WHERE status = 'completed'),
+                (SELECT COUNT(*) FROM subscriptions WHERE status = 'active'),
+                (SELECT COUNT(*) FROM subscriptions WHERE status = 'active' AND expires_at > strftime('%s', 'now'))
+        ''')
+        row = cur.fetchone()
+    _stats_cache = (time.monotonic() + STATS_CACHE_TTL, row)
+    return row
+
 @bot.message_handler(commands=['admin_stats'])
 @admin_only
 def admin_stats(message):
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT COUNT(*) FROM users')
-    users_count = cur.fetchone()[0]
-    cur.execute('SELECT COUNT(*) FROM users WHERE last_activity > datetime("now", "-7 days")')
-    active_week = cur.fetchone()[0]
-    cur.execute('SELECT COUNT(*) FROM payments WHERE status="completed"')
-    payments_count = cur.fetchone()[0]
-    cur.execute('SELECT SUM(amount) FROM payments WHERE status="completed"')
-    total_revenue = cur.fetchone()[0] or 0
-    cur.execute('SELECT COUNT(*) FROM subscriptions WHERE status="active"')
-    subs_total = cur.fetchone()[0]
-    cur.execute('SELECT COUNT(*) FROM subscriptions WHERE status="active" AND expires_at > datetime("now")')
-    subs_active = cur.fetchone()[0]
-    conn.close()
+    (users_count, active_week, payments_count,
+     total_revenue, subs_total, subs_active) = _fetch_stats()
     stats_text = (
-        f"📊 **СТАТИСТИКА MER VPN**\n\n"
-        f"👥 **Пользователи:**\n"
+        f"📊 <b>СТАТИСТИКА MER VPN</b>\n\n"
+        f"👥 <b>Пользователи:</b>\n"
         f"├ Всего: {users_count}\n"
         f"└ Активные (7д): {active_week}\n\n"
-        f"💰 **Финансы:**\n"
+        f"💰 <b>Финансы:</b>\n"
         f"├ Выручка: {total_revenue} ₽\n"
         f"└ Всего платежей: {payments_count}\n\n"
-        f"🔐 **Подписки:**\n"
+        f"🔐 <b>Подписки:</b>\n"
         f"├ Всего: {subs_total}\n"
         f"└ Активных: {subs_active}"
     )
-    bot.send_message(message.chat.id, stats_text, parse_mode='Markdown')
+    bot.send_message(message.chat.id, stats_text, parse_mode='HTML')
 
 @bot.message_handler(commands=['admin_broadcast'])
 @admin_only
@@ -749,20 +1196,93 @@ def admin_broadcast(message):
     if not text:
         bot.reply_to(message, "❌ Использование: /admin_broadcast Текст сообщения")
         return
-    conn = get_db()
-    cur = conn.cursor()
-    cur.execute('SELECT user_id FROM users')
-    users = cur.fetchall()
-    conn.close()
     sent = 0
     failed = 0
-    bot.reply_to(message, f"📨 Начинаю рассылку {len(users)} пользователям...")
-    for user in users:
+
+    # Отправка — сетевой I/O, поэтому шлём параллельно, но не быстрее
+    # BROADCAST_RATE сообщений в секунду (token bucket на deque)
+    rate_lock = threading.Lock()
+    send_times = deque()
+
+    def _wait_for_slot():
+        while True:
+            with rate_lock:
+                now = time.monotonic()
+                while send_times and now - send_times[0] >= 1.0:
+                    send_times.popleft()
+                if len(send_times) < BROADCAST_RATE:
+                    send_times.append(now)
+                    return
+                delay = 1.0 - (now - send_times[0])
+            time.sleep(max(delay, 0.01))
+
+    # Текст один и тот же для всех — форматируем один раз, а не на каждого.
+    # HTML вместо легаси-Markdown: парсер дешевле и непарный * в тексте
+    # админа не роняет все отправки разом
+    broadcast_text = f"📢 <b>Рассылка от администрации</b>\n\n{html.escape(text)}"
+    # Telegram парсит HTML на каждой отправке; после первой успешной берём
+    # готовые entities из ответа и дальше шлём plain-текст с ними
+    parsed = None
+
+    def _send_one(user_id):
+        nonlocal parsed
+        # Известно, что заблокировал бота — не тратим слот лимитера впустую
+        if user_id in _blocked_users:
+            return False
+        # 429 — не отказ, а просьба притормозить: ждём retry_after и повторяем,
+        # иначе часть рассылки молча терялась при каждом flood-лимите
+        for attempt in range(3):
+            _wait_for_slot()
+            try:
+                if parsed is not None:
+                    bot.send_message(user_id, parsed[0], entities=parsed[1])
+                else:
+                    msg = bot.send_message(user_id, broadcast_text, parse_mode='HTML')
+                    if msg.entities:
+                        parsed = (msg.text, msg.entities)
+                return True
+            except telebot.apihelper.ApiTelegramException as e:
+                if e.error_code == 403:
+                    _blocked_users.add(user_id)
+                    raise
+                if e.error_code == 429 and attempt < 2:
+                    retry_after = (e.result_json.get('parameters') or {}).get('retry_after', 2 ** attempt)
+                    time.sleep(retry_after + 0.1)
+                    continue
+                raise
+
+    def _collect(future):
+        nonlocal sent, failed
         try:
-            bot.send_message(user['user_id'], f"📢 **Рассылка от администрации**\n\n{text}", parse_mode='Markdown')
-            sent += 1
-        except:
+            if future.result():
+                sent += 1
+            else:
+                failed += 1  # пропущен как заблокировавший бота
+        except telebot.apihelper.ApiTelegramException as e:
+            # 403 — пользователь заблокировал бота, это ожидаемо и не шумим
+            if e.error_code != 403:
+                logger.warning(f"Рассылка: не доставлено: {e}")
+            failed += 1
+        except Exception as e:
+            logger.warning(f"Рассылка: не доставлено: {e}")
             failed += 1
+
+    # Стримим user_id прямо из курсора, не материализуя весь список в памяти;
+    # окно in-flight futures ограничено, чтобы память не росла с числом юзеров
+    with db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT COUNT(*) FROM users')
+        total = cur.fetchone()[0]
+        bot.reply_to(message, f"📨 Начинаю рассылку {total} пользователям...")
+        cur.execute('SELECT user_id FROM users')
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=BROADCAST_CONCURRENCY) as pool:
+            for (user_id,) in cur:
+                pending.append(pool.submit(_send_one, user_id))
+                if len(pending) >= BROADCAST_CONCURRENCY * 2:
+                    _collect(pending.popleft())
+            while pending:
+                _collect(pending.popleft())
     bot.send_message(message.chat.id, f"✅ Рассылка завершена\n├ Успешно: {sent}\n└ Ошибок: {failed}")
 
 @bot.message_handler(commands=['admin_add_balance'])
@@ -775,16 +1295,18 @@ def admin_add_balance(message):
             return
         user_id = int(parts[1])
         amount = int(parts[2])
-        update_user_balance(user_id, amount)
+        new_balance = update_user_balance(user_id, amount)
         bot.reply_to(message, f"✅ Баланс пользователя {user_id} пополнен на {amount} ₽")
+        if user_id in _blocked_users:
+            return
         try:
             bot.send_message(
                 user_id,
-                f"💰 **Баланс пополнен**\n\nСумма: +{amount} ₽\nТекущий баланс: {get_user_balance(user_id)} ₽\n\nИспользуй /start для обновления.",
-                parse_mode='Markdown'
+                f"💰 <b>Баланс пополнен</b>\n\nСумма: +{amount} ₽\nТекущий баланс: {new_balance} ₽\n\nИспользуй /start для обновления.",
+                parse_mode='HTML'
             )
-        except:
-            pass
+        except telebot.apihelper.ApiTelegramException:
+            pass  # пользователь заблокировал бота — баланс всё равно зачислен
     except Exception as e:
         bot.reply_to(message, f"❌ Ошибка: {e}")
 
@@ -792,23 +1314,47 @@ def admin_add_balance(message):
 @app.route('/webhook', methods=['POST'])
 def webhook_handler():
     try:
-        json_str = request.get_data(as_text=True)
-        update = telebot.types.Update.de_json(json_str)
-        bot.process_new_updates([update])
+        update = telebot.types.Update.de_json(json_loads(request.get_data()))
+        # Ответ Telegram сразу, обработка — в фоновой очереди;
+        # при переполнении отдаём 503 — Telegram сам повторит доставку
+        try:
+            _update_queue.put_nowait(lambda: bot.process_new_updates([update]))
+        except queue.Full:
+            logger.warning("⚠️ Очередь апдейтов переполнена, просим ретрай")
+            return 'Overloaded', 503
         return 'OK', 200
     except Exception as e:
         logger.error(f"Webhook error: {e}")
         return 'Error', 500
 
+# Статичная страница: байты и ETag считаем один раз, повторные заходы
+# из браузера получают 304 без какой-либо работы на сервере
+INDEX_BYTES = b'MER VPN Bot is running!'
+INDEX_ETAG = hashlib.md5(INDEX_BYTES).hexdigest()
+
 @app.route('/')
 def index():
-    return 'MER VPN Bot is running!'
+    if request.headers.get('If-None-Match') == INDEX_ETAG:
+        return '', 304
+    return Response(INDEX_BYTES, mimetype='text/plain',
+                    headers={'ETag': INDEX_ETAG, 'Cache-Control': 'public, max-age=3600'})
+
+# /health опрашивается балансировщиком каждые пару секунд — готовый ответ
+# пересобираем не чаще раза в секунду, а не на каждый заход
+_health_cache = {'body': b'', 'mono': 0.0}
 
 @app.route('/health')
 def health():
-    return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()})
+    now = time.monotonic()
+    if now - _health_cache['mono'] > 1.0:
+        _health_cache['body'] = json_dumps({'status': 'ok', 'timestamp': datetime.now().isoformat()})
+        _health_cache['mono'] = now
+    return Response(_health_cache['body'], mimetype='application/json')
 
 # ================ ЗАПУСК ================
+# В проде запускаемся через gunicorn (см. render.yaml):
+#   gunicorn -k gthread -w 2 --threads 8 bot:app
+# Однопоточный dev-сервер Werkzeug не вывозит max_connections=100 от Telegram
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8444))
-    app.run(host='0.0.0.0', port=port)
+    app.run(host='0.0.0.0', port=port, threaded=True)
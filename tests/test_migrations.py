@@ -0,0 +1,93 @@
+"""Миграции init_db: апгрейд заполненной БД с каждой прошлой версии схемы.
+
+Свежая база проходила миграции всегда; ломался именно апгрейд
+(DROP INDEX поверх незавершённого PRAGMA), поэтому каждый кейс стартует
+с непустой базы, откаченной до старого user_version.
+"""
+import os
+import sqlite3
+
+import pytest
+
+pytest.importorskip('telebot')
+pytest.importorskip('flask')
+
+os.environ.setdefault('BOT_TOKEN', '000000:test-token')
+os.environ.setdefault('WEBHOOK_URL', 'https://example.invalid/webhook')
+
+
+@pytest.fixture
+def bot_module(tmp_path, monkeypatch):
+    # init_db работает с относительным 'mer.db' — каждому тесту свой каталог
+    monkeypatch.chdir(tmp_path)
+    import bot
+    return bot
+
+
+# Каких индексов текущей схемы ещё не существовало на каждой версии
+# (см. комментарий к SCHEMA_VERSION в bot.py)
+_MISSING_ON_VERSION = {
+    1: ['idx_payments_status_amount', 'idx_subs_user_active',
+        'idx_subs_status_exp', 'idx_users_last_activity'],
+    2: ['idx_payments_status_amount', 'idx_subs_status_exp',
+        'idx_users_last_activity'],
+    3: ['idx_payments_status_amount', 'idx_users_last_activity'],
+    4: ['idx_payments_status_amount'],
+}
+
+
+def _downgrade_to(old_version):
+    """Откатывает свежую БД к виду версии old_version, с данными."""
+    conn = sqlite3.connect('mer.db')
+    conn.execute("INSERT INTO users (user_id, balance) VALUES (1, 100)")
+    conn.execute(
+        "INSERT INTO payments (user_id, amount, status, payment_id) "
+        "VALUES (1, 100, 'completed', 'p1')"
+    )
+    for name in _MISSING_ON_VERSION[old_version]:
+        conn.execute(f'DROP INDEX IF EXISTS {name}')
+    if old_version >= 2:
+        # Узкий индекс, который v5 заменяет покрывающим (status, amount)
+        conn.execute(
+            'CREATE INDEX IF NOT EXISTS idx_payments_status ON payments(status)'
+        )
+    if old_version < 2:
+        # До v2 expires_at хранился текстом
+        conn.execute(
+            "INSERT INTO subscriptions (user_id, marzban_username, expires_at) "
+            "VALUES (1, 'user_1_30_0', '2030-01-01 00:00:00')"
+        )
+    conn.execute(f'PRAGMA user_version = {old_version}')
+    conn.commit()
+    conn.close()
+
+
+def test_fresh_db(bot_module):
+    bot_module.init_db()
+    conn = sqlite3.connect('mer.db')
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == bot_module.SCHEMA_VERSION
+    indexes = {row[1] for row in conn.execute('PRAGMA index_list(payments)')}
+    assert 'idx_payments_status_amount' in indexes
+    conn.close()
+
+
+@pytest.mark.parametrize('old_version', sorted(_MISSING_ON_VERSION))
+def test_upgrade_from_prior_schema(bot_module, old_version):
+    bot_module.init_db()
+    _downgrade_to(old_version)
+
+    # Собственно миграция: до фикса PRAGMA/fetchone падала на v2-v4
+    # с "database table is locked" на DROP INDEX
+    bot_module.init_db()
+
+    conn = sqlite3.connect('mer.db')
+    assert conn.execute('PRAGMA user_version').fetchone()[0] == bot_module.SCHEMA_VERSION
+    indexes = {row[1] for row in conn.execute('PRAGMA index_list(payments)')}
+    assert 'idx_payments_status_amount' in indexes
+    assert 'idx_payments_status' not in indexes
+    assert conn.execute('SELECT balance FROM users WHERE user_id = 1').fetchone()[0] == 100
+    if old_version < 2:
+        assert conn.execute(
+            'SELECT typeof(expires_at) FROM subscriptions'
+        ).fetchone()[0] == 'integer'
+    conn.close()